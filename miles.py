@@ -2,53 +2,141 @@
 
 ''' miles.py - Web crawler to download files in parallel. '''
 
-from typing import Iterator, Optional
+from typing import Iterable, Iterator, Optional
 
+import argparse
 import os
 import concurrent.futures
-import itertools
+import functools
+import http.server
+import logging
+import queue
+import random
 import re
 import sys
 import tempfile
+import threading
 import time
 import urllib.parse
 
 import requests
+import requests.adapters
+
+try:
+    from selectolax.lexbor import LexborHTMLParser
+except ImportError:
+    LexborHTMLParser = None
+
+try:
+    import lxml.etree
+except ImportError:
+    lxml = None
 
 # Constants
 
 FILE_REGEX = {
-    'jpg': [r'<img.*src="?([^\" ]+.jpg)', r'<a.*href="?([^\" ]+.jpg)'],  # TODO
-    'mp3': [r'<audio.*src="?([^\" ]+.mp3)', r'<a.*href="?([^\" ]+.mp3)'],  # TODO
-    'pdf': [r'<a.*href="?([^\" ]+.pdf)'],  # TODO
-    'png': [r'<img.*src="?([^\" ]+.png)', r'<a.*href="?([^\" ]+.png)'],  # TODO
+    'jpg': [re.compile(r'<img\b[^>]*?\bsrc="?([^"\s>]+\.jpg)'), re.compile(r'<a\b[^>]*?\bhref="?([^"\s>]+\.jpg)')],
+    'mp3': [re.compile(r'<audio\b[^>]*?\bsrc="?([^"\s>]+\.mp3)'), re.compile(r'<a\b[^>]*?\bhref="?([^"\s>]+\.mp3)')],
+    'pdf': [re.compile(r'<a\b[^>]*?\bhref="?([^"\s>]+\.pdf)')],
+    'png': [re.compile(r'<img\b[^>]*?\bsrc="?([^"\s>]+\.png)'), re.compile(r'<a\b[^>]*?\bhref="?([^"\s>]+\.png)')],
 }
 
+FILE_SELECTOR = 'img[src], audio[src], a[href]'
+FILE_TAGS     = ('img', 'audio', 'a')
+
 MEGABYTES   = 1<<20
 DESTINATION = '.'
-CPUS        = 1
+WORKERS     = 10
+TIMEOUT     = (5, 30)
+CHUNK_SIZE  = 1<<16
+WRITE_CHUNK = 1<<20
+WRITE_QUEUE = 4
+POOL_SIZE   = 20
+PER_HOST    = 5
+JITTER      = 0.1
+
+# Pooled keep-alive connections only resolve and handshake with a host once,
+# so downloads after the first per connection skip getaddrinfo() entirely.
+SESSION = requests.Session()
+SESSION.headers['User-Agent'] = 'miles.py'
+
+LOGGER = logging.getLogger('miles')
+
+HOST_SEMAPHORES: dict[tuple[str, int], threading.Semaphore] = {}
+HOST_LOCK = threading.Lock()
 
 # Functions
 
-def usage(exit_status: int=0) -> None:
-    ''' Print usgae message and exit. '''
-    print(f'''Usage: miles.py [-d DESTINATION -n CPUS -f FILETYPES] URL
+def mount_adapters(pool_size: int=POOL_SIZE) -> None:
+    ''' Mount HTTP adapters on SESSION that keep up to pool_size connections
+    per host, closing the adapters they replace.
+    '''
+    for prefix in ('http://', 'https://'):
+        if prefix in SESSION.adapters:
+            SESSION.adapters[prefix].close()
+        SESSION.mount(prefix, requests.adapters.HTTPAdapter(
+            pool_connections=10, pool_maxsize=pool_size, max_retries=0
+        ))
 
-Crawl the given URL for the specified FILETYPES and download the files to the
-DESTINATION folder using CPUS cores in parallel.
+mount_adapters()
 
-    -d DESTINATION      Save the files to this folder (default: {DESTINATION})
-    -n CPUS             Number of CPU cores to use (default: {CPUS})
-    -f FILETYPES        List of file types: jpg, mp3, pdf, png (default: all)
+def positive_int(value: str) -> int:
+    ''' Convert a command line value to an int greater than zero.
 
-Multiple FILETYPES can be specified in the following manner:
+    >>> positive_int('5')
+    5
 
-    -f jpg,png
-    -f jpg -f png''', file=sys.stderr)
-    sys.exit(exit_status)
+    >>> positive_int('0')
+    Traceback (most recent call last):
+    ...
+    argparse.ArgumentTypeError: 0 is not a positive integer
+    '''
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError(f'{value} is not a positive integer')
+    return number
+
+def parse_arguments(arguments: list[str]) -> argparse.Namespace:
+    ''' Parse command line arguments, splitting comma separated FILETYPES.
+
+    >>> args = parse_arguments('-n 4 -f jpg,png -f pdf https://example.com/'.split())
+    >>> args.workers, args.filetypes, args.url
+    (4, ['jpg', 'png', 'pdf'], 'https://example.com/')
+    '''
+    parser = argparse.ArgumentParser(
+        prog='miles.py',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description='''Crawl the given URL for the specified FILETYPES and download the files to the
+DESTINATION folder using WORKERS threads in parallel.''',
+        epilog='''Multiple FILETYPES can be specified in the following manner:
 
-def resolve_url(base: str, url: str) -> str:
-    ''' Resolve absolute url from base url and possibly relative url.
+    -f jpg,png
+    -f jpg -f png''',
+    )
+    parser.add_argument('-d', dest='destination', metavar='DESTINATION', default=DESTINATION,
+                        help=f'Save the files to this folder (default: {DESTINATION})')
+    parser.add_argument('-n', dest='workers', metavar='WORKERS', type=positive_int, default=WORKERS,
+                        help=f'Number of download workers to use (default: {WORKERS})')
+    parser.add_argument('-c', dest='per_host', metavar='PER_HOST', type=positive_int, default=PER_HOST,
+                        help=f'Number of concurrent downloads per host (default: {PER_HOST})')
+    parser.add_argument('-f', dest='filetypes', metavar='FILETYPES', action='append', default=[],
+                        help='List of file types: jpg, mp3, pdf, png (default: all)')
+    parser.add_argument('url', metavar='URL')
+    args = parser.parse_args(arguments)
+    args.filetypes = [
+        filetype for value in args.filetypes for filetype in value.split(',')
+    ]
+    unknown = [filetype for filetype in args.filetypes if filetype not in FILE_REGEX]
+    if unknown:
+        parser.error(f'unknown file types: {", ".join(unknown)}')
+    return args
+
+def resolve_url(base: str, url: str, parts: Optional[urllib.parse.SplitResult]=None) -> str:
+    ''' Resolve absolute url from base url and possibly relative url, using
+    parts (default: urlsplit of base) to skip urljoin for common cases.
 
     >>> base = 'https://www3.nd.edu/~pbui/teaching/cse.20289.sp24/'
     >>> resolve_url(base, 'static/img/ostep.jpg')
@@ -56,11 +144,30 @@ def resolve_url(base: str, url: str) -> str:
 
     >>> resolve_url(base, 'https://automatetheboringstuff.com/')
     'https://automatetheboringstuff.com/'
+
+    >>> resolve_url(base, '/~pbui/static/img/ostep.jpg')
+    'https://www3.nd.edu/~pbui/static/img/ostep.jpg'
+
+    >>> resolve_url(base, '//example.com/ostep.jpg')
+    'https://example.com/ostep.jpg'
+
+    >>> resolve_url('https://h/x/', '/a/../b.jpg')
+    'https://h/b.jpg'
+
+    >>> resolve_url(base, 'ostep.jpg?mirror=https://example.com/')
+    'https://www3.nd.edu/~pbui/teaching/cse.20289.sp24/ostep.jpg?mirror=https://example.com/'
     '''
-    if 'https://' in url:
+    if url.startswith(('http://', 'https://')):
         return url
-    else:
+    if '/.' in url:
         return urllib.parse.urljoin(base, url)
+    if parts is None:
+        parts = urllib.parse.urlsplit(base)
+    if url.startswith('//'):
+        return f'{parts.scheme}:{url}'
+    if url.startswith('/'):
+        return f'{parts.scheme}://{parts.netloc}{url}'
+    return urllib.parse.urljoin(base, url)
 
 def extract_urls(url: str, file_types: list[str]) -> Iterator[str]:
     ''' Extract urls of specified file_types from url.
@@ -73,50 +180,257 @@ def extract_urls(url: str, file_types: list[str]) -> Iterator[str]:
     2
     '''
     try:
-        response = requests.get(url)
-        response.raise_for_status()
+        response = SESSION.get(url, timeout=TIMEOUT, stream=True)
     except requests.exceptions.RequestException:
         return
-    data = response.text
-    for filetype in file_types:
-        for regex in FILE_REGEX[filetype]:
-            for match in re.findall(regex, data):
-                yield resolve_url(url, match)
+    extensions = tuple(f'.{filetype}' for filetype in file_types)
+    parts = urllib.parse.urlsplit(url)
+    seen: set[str] = set()
+    with response:
+        try:
+            response.raise_for_status()
+            if LexborHTMLParser is not None:
+                links = lexbor_links(response.content)
+            elif lxml is not None:
+                # requests assumes ISO-8859-1 for text/* without a charset, which
+                # would override the page's own <meta charset>
+                declared = 'charset' in response.headers.get('content-type', '').lower()
+                encoding = response.encoding if declared else None
+                links = lxml_links(response.iter_content(chunk_size=CHUNK_SIZE), encoding)
+            else:
+                data = response.content.decode(response.encoding or 'utf-8', 'replace')
+                links = regex_links(data, file_types)
+            for link in links:
+                if not link.lower().endswith(extensions):
+                    continue
+                link = resolve_url(url, link, parts)
+                if link not in seen:
+                    seen.add(link)
+                    yield link
+        except requests.exceptions.RequestException:
+            return
+
+def lexbor_links(data: bytes) -> Iterator[str]:
+    ''' Yield file links from html data parsed with selectolax. '''
+    tree = LexborHTMLParser(data)
+    for node in tree.css(FILE_SELECTOR):
+        link = node.attrs.get('href' if node.tag == 'a' else 'src')
+        if link:
+            yield link
+
+def lxml_links(chunks: Iterable[bytes], encoding: Optional[str]=None) -> Iterator[str]:
+    ''' Yield file links from streamed html chunks as they arrive, clearing
+    parsed elements so memory stays bounded by the chunk size.
+
+    >>> chunks = [b'<html><body><img src="a.jpg"><p>text</p><a hr', b'ef="b.pdf">b</a>']
+    >>> list(lxml_links(chunks))
+    ['a.jpg', 'b.pdf']
+
+    >>> list(lxml_links([]))
+    []
+    '''
+    parser = lxml.etree.HTMLPullParser(events=('start', 'end'), encoding=encoding)
+
+    def links() -> Iterator[str]:
+        for event, element in parser.read_events():
+            if event == 'start':
+                if element.tag in FILE_TAGS:
+                    link = element.get('href' if element.tag == 'a' else 'src')
+                    if link:
+                        yield link
+                continue
+            element.clear()
+            parent = element.getparent()
+            if parent is not None:
+                while element.getprevious() is not None:
+                    del parent[0]
+
+    for chunk in chunks:
+        parser.feed(chunk)
+        yield from links()
+    try:
+        parser.close()
+    except lxml.etree.XMLSyntaxError:
+        return
+    yield from links()
 
-def download_url(url: str, destination: str=DESTINATION) -> Optional[str]:
-    ''' Download url to destination folder.
+@functools.lru_cache(maxsize=None)
+def combined_regex(file_types: tuple[str, ...]) -> re.Pattern:
+    ''' Return a single pattern matching any FILE_REGEX pattern for file_types. '''
+    return re.compile('|'.join(
+        regex.pattern for filetype in file_types for regex in FILE_REGEX[filetype]
+    ))
+
+def regex_links(data: str, file_types: list[str]) -> Iterator[str]:
+    ''' Yield file links from html data matched with FILE_REGEX in one pass.
+
+    >>> data = '<a href="a.pdf"><img src="a.jpg"></a> <audio src="b.mp3">'
+    >>> list(regex_links(data, ['jpg', 'pdf']))
+    ['a.pdf', 'a.jpg']
+    '''
+    regex = combined_regex(tuple(sorted(set(file_types))))
+    for match in regex.finditer(data):
+        yield match[match.lastindex]
+
+def unique_name(url: str, names: set[str]) -> str:
+    ''' Return the basename of url, numbered so that it is not already in names.
+
+    >>> names = set()
+    >>> unique_name('https://example.com/a/photo.jpg', names)
+    'photo.jpg'
+
+    >>> unique_name('https://example.com/b/photo.jpg', names)
+    'photo-1.jpg'
+    '''
+    name = os.path.basename(url.rstrip('/'))
+    stem, extension = os.path.splitext(name)
+    count = 1
+    while name in names:
+        name = f'{stem}-{count}{extension}'
+        count += 1
+    names.add(name)
+    return name
+
+def host_semaphore(url: str, per_host: int=PER_HOST) -> threading.Semaphore:
+    ''' Return the semaphore limiting concurrent downloads from the host of url. '''
+    key = (urllib.parse.urlsplit(url).netloc, per_host)
+    with HOST_LOCK:
+        if key not in HOST_SEMAPHORES:
+            HOST_SEMAPHORES[key] = threading.Semaphore(per_host)
+        return HOST_SEMAPHORES[key]
+
+def skip_written(views: list[memoryview], written: int) -> list[memoryview]:
+    ''' Return the parts of views left over after written bytes were written.
+
+    >>> views = [memoryview(b'abc'), memoryview(b'de'), memoryview(b'f')]
+    >>> [bytes(view) for view in skip_written(views, 4)]
+    [b'e', b'f']
+
+    >>> [bytes(view) for view in skip_written(views, 3)]
+    [b'de', b'f']
+
+    >>> skip_written(views, 6)
+    []
+    '''
+    views = list(views)
+    while views and written >= len(views[0]):
+        written -= len(views.pop(0))
+    if views and written:
+        views[0] = views[0][written:]
+    return views
+
+def write_vector(fd: int, batch: list[bytes]) -> None:
+    ''' Write every chunk in batch to fd, with a single writev() call where
+    the platform has one.
+
+    >>> with tempfile.TemporaryFile(buffering=0) as stream:
+    ...     write_vector(stream.fileno(), [b'abc', b'de', b'f'])
+    ...     _ = stream.seek(0)
+    ...     stream.read()
+    b'abcdef'
+    '''
+    views = [memoryview(chunk) for chunk in batch]
+    while views:
+        if hasattr(os, 'writev'):
+            written = os.writev(fd, views)
+        else:
+            written = os.write(fd, views[0])
+        if not written:
+            raise OSError(f'write to fd {fd} made no progress')
+        views = skip_written(views, written)
+
+def write_chunks(stream, chunks: queue.Queue, errors: list[OSError]) -> None:
+    ''' Write chunks from the queue to stream until None is received, holding
+    on to the first write error in errors and discarding the chunks after it.
+    Chunks that queue up while a write is in progress are written together.
+    '''
+    done = False
+    while not done:
+        batch = [chunks.get()]
+        while not chunks.empty():
+            batch.append(chunks.get_nowait())
+        if batch[-1] is None:
+            batch.pop()
+            done = True
+        if errors or not batch:
+            continue
+        try:
+            write_vector(stream.fileno(), batch)
+        except OSError as error:
+            errors.append(error)
+
+def download_url(url: str, destination: str=DESTINATION, name: Optional[str]=None, per_host: int=PER_HOST) -> Optional[tuple[str, int]]:
+    ''' Download url to destination folder as name (default: basename of url)
+    and return its path and size, with at most per_host downloads from the
+    same host at once. If the request or writing the file fails, any partial
+    file is removed and None is returned.
 
     >>> url = 'https://www3.nd.edu/~pbui/teaching/cse.20289.sp24/static/img/ostep.jpg'
     >>> destination = tempfile.TemporaryDirectory()
 
-    >>> path = download_url(url, destination.name)
-    Downloading https://www3.nd.edu/~pbui/teaching/cse.20289.sp24/static/img/ostep.jpg...
+    >>> path, size = download_url(url, destination.name)
 
     >>> path # doctest: +ELLIPSIS
     '/tmp/.../ostep.jpg'
 
-    >>> os.stat(path).st_size
+    >>> size
     53696
 
+    A failed request leaves any file already at the destination alone.
+
+    >>> server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), http.server.SimpleHTTPRequestHandler)
+    >>> threading.Thread(target=server.serve_forever, daemon=True).start()
+    >>> existing = os.path.join(destination.name, 'missing.pdf')
+    >>> with open(existing, 'w') as stream:
+    ...     _ = stream.write('keep me')
+    >>> download_url(f'http://127.0.0.1:{server.server_port}/missing.pdf', destination.name) is None
+    True
+    >>> open(existing).read()
+    'keep me'
+    >>> server.shutdown()
+
     >>> destination.cleanup()
     '''
-    print(f'Downloading {url}...')
+    LOGGER.info('Downloading %s...', url)
+    if url[-1] == '/':
+        url = url[:-1]
+    filename = os.path.join(destination, name or os.path.basename(url))
+    size = 0
+    created = False
+    errors: list[OSError] = []
     try:
-        response = requests.get(url)
-        response.raise_for_status()
+        with host_semaphore(url, per_host):
+            time.sleep(random.random() * JITTER)
+            with SESSION.get(url, timeout=TIMEOUT, stream=True) as response:
+                response.raise_for_status()
+                with open(filename, 'wb', buffering=0) as stream:
+                    created = True
+                    chunks: queue.Queue = queue.Queue(maxsize=WRITE_QUEUE)
+                    writer = threading.Thread(target=write_chunks, args=(stream, chunks, errors))
+                    writer.start()
+                    try:
+                        for chunk in response.iter_content(chunk_size=WRITE_CHUNK):
+                            if errors:
+                                break
+                            chunks.put(chunk)
+                            size += len(chunk)
+                    finally:
+                        chunks.put(None)
+                        writer.join()
     except requests.exceptions.RequestException:
+        if created:
+            os.remove(filename)
         return None
-    if url[-1] == '/':
-        url = url[:-1]
-    filename = os.path.join(destination, os.path.basename(url))
-    with open(filename, 'wb') as stream:
-        stream.write(response.content)
-    return str(filename)
+    if errors:
+        LOGGER.error('Could not write %s: %s', filename, errors[0])
+        os.remove(filename)
+        return None
+    return str(filename), size
         
 
-def crawl(url: str, file_types: list[str], destination: str=DESTINATION, cpus: int=CPUS) -> None:
+def crawl(url: str, file_types: list[str], destination: str=DESTINATION, workers: int=WORKERS, per_host: int=PER_HOST) -> None:
     ''' Crawl the url for the specified file type(s) and download all found
-    files to destination folder.
+    files to destination folder, at most per_host at a time from each host.
 
     >>> url = 'https://www3.nd.edu/~pbui/teaching/cse.20289.sp24/'
     >>> destination = tempfile.TemporaryDirectory()
@@ -128,21 +442,36 @@ def crawl(url: str, file_types: list[str], destination: str=DESTINATION, cpus: i
 
     >>> destination.cleanup()
     '''
-    sites = extract_urls(url, file_types)
-    dests = itertools.repeat(destination)
+    if per_host < 1:
+        raise ValueError(f'per_host must be positive, not {per_host}')
     file_num = 0
-    start = time.time()
-    files = []
-    with concurrent.futures.ProcessPoolExecutor(max_workers=cpus) as executor:
-        for file in executor.map(download_url, sites, dests):
-            if not file:
-                continue
-            file_num += 1
-            files.append(file)
-    total_time = float(time.time()) - start
-    size_list = (os.stat(file).st_size for file in files)
-    size_total = sum(size_list) / 1048576
-    download_speed: float = size_total/total_time
+    size_total: float = 0
+    start = time.perf_counter()
+    # Keep one pooled connection per concurrent download to a host rather
+    # than discarding the extras, and restore the default pool afterwards
+    pool_size = min(workers, per_host)
+    if pool_size > POOL_SIZE:
+        mount_adapters(pool_size)
+    names: set[str] = set()
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(download_url, site, destination, unique_name(site, names), per_host)
+                for site in extract_urls(url, file_types)
+            ]
+            for future in concurrent.futures.as_completed(futures):
+                result = future.result()
+                if not result:
+                    continue
+                _, size = result
+                file_num += 1
+                size_total += size
+    finally:
+        if pool_size > POOL_SIZE:
+            mount_adapters()
+    total_time = time.perf_counter() - start
+    size_total /= MEGABYTES
+    download_speed: float = size_total/total_time if total_time else 0.0
     print(f'Files Downloaded: {file_num}')
     print(f'Bytes Downloaded: {size_total:.2f} MB')
     print(f'Elapsed Time:     {total_time:.2f} s')
@@ -153,7 +482,7 @@ def crawl(url: str, file_types: list[str], destination: str=DESTINATION, cpus: i
 
 def main(arguments=sys.argv[1:]) -> None:
     ''' Process command line arguments, crawl URL for specified FILETYPES,
-    download files to DESTINATION folder using CPUS cores.
+    download files to DESTINATION folder using WORKERS threads.
 
     >>> url = 'https://www3.nd.edu/~pbui/teaching/cse.20289.sp24/'
     >>> destination = tempfile.TemporaryDirectory()
@@ -165,36 +494,13 @@ def main(arguments=sys.argv[1:]) -> None:
 
     >>> destination.cleanup()
     '''
-    destination = ''
-    filetypes: list[str] = []
-    cpus = CPUS
-    url = ''
-    while arguments:
-        argument = arguments.pop(0)
-        if argument == '-d':
-            directory = arguments.pop(0)
-            if os.path.exists(directory):
-                destination = directory
-            else:
-                os.makedirs(directory)
-                destination = directory
-        elif argument == '-f':
-            filetypes += arguments.pop(0).split(',')
-        elif argument == '-h':
-            usage(0)
-        elif argument == '-n':
-            cpus = int(arguments.pop(0))
-        elif argument[0] == '-':
-            usage(1)
-        else:
-            if url == '':
-                url = argument
-            else:
-                usage(1)
-    if not filetypes:
-        filetypes = ['mp3', 'png', 'jpg', 'pdf']
-    if not url:
-        usage(1)
-    crawl(url, filetypes, destination, cpus)
+    args = parse_arguments(arguments)
+    os.makedirs(args.destination, exist_ok=True)
+    if not LOGGER.handlers:
+        LOGGER.addHandler(logging.StreamHandler(sys.stderr))
+        LOGGER.setLevel(logging.INFO)
+    filetypes = args.filetypes or ['mp3', 'png', 'jpg', 'pdf']
+    crawl(args.url, filetypes, args.destination, args.workers, args.per_host)
+
 if __name__ == '__main__':
     main()
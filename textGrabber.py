@@ -2,73 +2,85 @@
 
 ''' textGrabber.py - Script to download text from a website '''
 
+import argparse
 import sys
 import time
-from bs4 import BeautifulSoup as soup
+
 import requests
+import requests.adapters
+
+try:
+    from selectolax.lexbor import LexborHTMLParser
+except ImportError:
+    LexborHTMLParser = None
+    from bs4 import BeautifulSoup as soup
 
 # Constants
 
 DESTINATION = 'text_grabber_data.txt'
 URL = 'https://automatetheboringstuff.com'
+TIMEOUT = (5, 30)
+BUFFER_SIZE = 1<<19
 
-# Functions
+SESSION = requests.Session()
+SESSION.headers['User-Agent'] = 'textGrabber.py'
+for prefix in ('http://', 'https://'):
+    SESSION.mount(prefix, requests.adapters.HTTPAdapter(
+        pool_connections=10, pool_maxsize=20, max_retries=0
+    ))
 
-def usage(exit_status: int=0) -> None:
-    ''' Print usgae message and exit. '''
-    print(f'''Usage: textGrabber.py [-d DESTINATION] URL
+# Functions
 
-Download the text of the given url.
-    -d DESTINATION      Save the files to this file (default: {DESTINATION})
-''', file=sys.stderr)
-    sys.exit(exit_status)
+def parse_arguments(arguments: list[str]) -> argparse.Namespace:
+    ''' Parse command line arguments.
+    '''
+    parser = argparse.ArgumentParser(
+        prog='textGrabber.py',
+        description='Download the text of the given url.',
+    )
+    parser.add_argument('-d', dest='destination', metavar='DESTINATION', default=DESTINATION,
+                        help=f'Save the files to this file (default: {DESTINATION})')
+    parser.add_argument('url', metavar='URL', nargs='?', default=URL)
+    return parser.parse_args(arguments)
 
 def download_html(url: str) -> str:
     ''' Download url and return html as string
     '''
     print(f'Downloading {url}...')
-    start = time.time()
+    start = time.perf_counter()
     try:
-        response = requests.get(url)
+        response = SESSION.get(url, timeout=TIMEOUT)
         response.raise_for_status()
     except requests.exceptions.RequestException:
         return ''
     if url[-1] == '/':
         url = url[:-1]
-    total_time = float(time.time()) - start
+    total_time = time.perf_counter() - start
     print(f'Elapsed Time:     {total_time:.2f} s')
     return response.text
     
 def format_remove_html(html_data: str, destination: str):
     ''' Removes everything but plaintext from html file and writes to specified file
     '''
-    file_soup = soup(html_data, 'html.parser')
-    with open(destination, 'w') as write_stream:
-        write_stream.write(file_soup.get_text())
+    if LexborHTMLParser is not None:
+        tree = LexborHTMLParser(html_data)
+        node = tree.body or tree.root
+        text = node.text(separator='\n') if node else ''
+    else:
+        text = soup(html_data, 'lxml').get_text('\n')
+    with open(destination, 'w', buffering=BUFFER_SIZE, encoding='utf-8') as write_stream:
+        write_stream.write(text)
 
 # Main Execution
 def main(arguments=sys.argv[1:]) -> None:
     ''' Download html data, format into plaintext, save to file
     '''
-    destination = DESTINATION
-    url = URL
-    url_set = 0
-    while arguments:
-        argument = arguments.pop(0)
-        if argument == '-d':
-            destination = arguments.pop(0)
-        elif argument == '-h':
-            usage(0)
-        else:
-            if url_set == 1:
-                usage(1)
-            url_set = 1
-            url = argument
-    html_data = download_html(url)
+    args = parse_arguments(arguments)
+    html_data = download_html(args.url)
     if not html_data:
         exit(1)
-    format_remove_html(html_data, destination)
-    print(f'Saved to {destination}')
+    format_remove_html(html_data, args.destination)
+    print(f'Saved to {args.destination}')
     
 if __name__ == '__main__':
     main()